@@ -74,11 +74,13 @@ class TensorCache:
         else:
             gather_indices = torch.tensor(indices, dtype=torch.long, device=self.device)
         for cache_id in cache_ids:
-            tensor_block = self.caches[cache_id]
-            tensor_gather = tensor_block.index_select(dim=0, index=gather_indices)
-            tensors_gathered.append(tensor_gather)
+            tensors_gathered.append(self.index_select(gather_indices, cache_id))
         return tensors_gathered
 
+    def index_select(self, indices, cache_id):
+        # Gather rows of a single cache slot without packing them into a list
+        return self.caches[cache_id].index_select(dim=0, index=indices)
+
     def fill(self, cache_id_offset, cache_id_len, cache_ids, values):
         if len(cache_ids) != len(values):
             raise Exception('TensorCache::fill names and values mismatch')
@@ -47,8 +47,8 @@ class GlueEvaluater:
                         inputs[k] = v.to(self.device)
                 labels = inputs.pop('labels')
                 with torch.no_grad():
-                    probs = self.model(**inputs, force_encoding=self.force_encoding)
-                predict_labels = probs.argmax(dim=-1)
+                    logits = self.model(**inputs, force_encoding=self.force_encoding)
+                predict_labels = logits.argmax(dim=-1)
                 for pred_label in predict_labels:
                     pred_labels.append(pred_label)
                 for gold_label in labels:
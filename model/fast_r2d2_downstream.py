@@ -2,18 +2,25 @@
 # Copyright (c) 2021 Ant Group
 # Author: Xiang Hu
 
+from contextlib import nullcontext
 from typing import List, Tuple
 import torch.nn as nn
 import torch.nn.functional as F
 import torch
 from .r2d2_common import CacheSlots
 from .r2d2_cuda import R2D2Cuda
-from .topdown_parser import TopdownParser
+from .topdown_parser import TopdownParser, PackedAtomSpans, pack_atom_spans
 from utils.model_loader import load_model
 from .fast_r2d2_inference import force_encode
 
 
-class FastR2D2Classification(nn.Module):
+@torch.jit.script
+def _scripted_classifier_logits(x, w1, b1, w2, b2):
+    # Linear-GELU-Dropout-Linear, dropout is an identity in eval mode
+    return F.linear(F.gelu(F.linear(x, w1, b1)), w2, b2)
+
+
+class FastR2D2DownstreamBase(nn.Module):
     def __init__(self, config, label_num, disable_parser=False):
         super().__init__()
         self.r2d2 = R2D2Cuda(config)
@@ -23,108 +30,178 @@ class FastR2D2Classification(nn.Module):
                                         nn.Dropout(config.hidden_dropout_prob),
                                         nn.Linear(config.intermediate_size, label_num))
         self.disable_parser = disable_parser
+        # run the force encoding, pairwise decoder and classifier matmuls in bf16, requires torch >= 1.10
+        self.autocast_bf16 = getattr(config, 'autocast_bf16', False)
+        # weights of the classification losses on sampled trees and force encoding, when the sampled weight is 0
+        # the sampled tree pass is skipped together with its bilm and kl losses, e.g. to train force-only after warmup
+        sampled_loss_weight = getattr(config, 'sampled_loss_weight', None)
+        force_loss_weight = getattr(config, 'force_loss_weight', None)
+        # configs may return None for missing attributes instead of raising
+        self.sampled_loss_weight = 1.0 if sampled_loss_weight is None else float(sampled_loss_weight)
+        self.force_loss_weight = 1.0 if force_loss_weight is None else float(force_loss_weight)
 
-    def from_pretrain(self, model_path, parser_path):
-        self.r2d2.from_pretrain(model_path)
-        load_model(self.parser, parser_path)
+    def from_pretrain(self, model_path, parser_path=None):
+        """
+        Load r2d2 and parser from separate files, or from a single merged checkpoint
+        with r2d2.* and parser.* keys if parser_path is not given.
+        """
+        if parser_path is None:
+            result = load_model(self, model_path, strict=False, mmap=True)
+            # only the task classifier may be absent from a merged checkpoint
+            missing_keys = [k for k in result.missing_keys if not k.startswith('classifier.')]
+            if len(missing_keys) > 0 or len(result.unexpected_keys) > 0:
+                raise Exception(f'{model_path} is not a merged r2d2 and parser checkpoint, '
+                                f'missing keys: {missing_keys}, unexpected keys: {result.unexpected_keys}')
+            self.r2d2._tie_weights()
+        else:
+            self.r2d2.from_pretrain(model_path)
+            load_model(self.parser, parser_path)
 
     def load_model(self, model_path):
-        load_model(self, model_path)
+        load_model(self, model_path, mmap=True)
         self.r2d2._tie_weights()
 
+    def predict(self, *args, **kwargs):
+        # forward returns logits when labels are not given, argmax doesn't need the softmax
+        return self(*args, **kwargs).argmax(dim=-1)
+
+    def predict_proba(self, *args, **kwargs):
+        return F.softmax(self(*args, **kwargs), dim=-1)
+
+    def classifier_forward(self, x):
+        """
+        Same as self.classifier(x) without dispatching through nn.Sequential,
+        the parameters are still owned by self.classifier.
+        """
+        dense, _, dropout, output = self.classifier
+        if not self.training and not self.autocast_bf16:
+            # the scripted function is not covered by autocast, so it is only used in fp32
+            return _scripted_classifier_logits(x, dense.weight, dense.bias, output.weight, output.bias)
+        hidden = F.dropout(F.gelu(F.linear(x, dense.weight, dense.bias)), p=dropout.p, training=self.training)
+        return F.linear(hidden, output.weight, output.bias)
+
+    def autocast(self):
+        # R2D2Cuda.forward hands its tensors to the r2d2lib kernels and the parser to cudnn LSTM,
+        # both are kept out of the autocast region and stay in fp32
+        if self.autocast_bf16:
+            return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+        return nullcontext()
+
+    def gather_root_e_ij(self, tables, tensor_cache):
+        root_cache_ids = torch.tensor([t.root_cache_id for t in tables], dtype=torch.long,
+                                      device=tensor_cache.device)
+        return tensor_cache.index_select(root_cache_ids, CacheSlots.E_IJ)
+
+
+class FastR2D2Classification(FastR2D2DownstreamBase):
     def forward(self, input_ids: torch.Tensor,
                 attention_mask: torch.Tensor,
                 num_samples: int = 0,
                 atom_spans: List[List[Tuple[int]]] = None,
                 labels: torch.Tensor = None,
                 force_encoding=False):
+        if atom_spans is not None and not isinstance(atom_spans, PackedAtomSpans):
+            # pack once, shared by all parser calls below
+            atom_spans = pack_atom_spans(atom_spans, device=input_ids.device)
         if labels is not None:
             # training
-            if not self.disable_parser:
-                s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
+            sampled = self.sampled_loss_weight > 0
+            # sampled and forced merge orders share one parser encoding
+            if sampled and not self.disable_parser:
+                s_indices, forced_indices, parser_encoding = self.parser.parse_with_forced(input_ids, attention_mask,
+                                                                                           atom_spans=atom_spans)
             else:
                 s_indices = None
-            results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
-                                sample_trees=num_samples, recover_tree=True, keep_tensor_cache=True)
-            tables = results['tables']
-            tensor_cache = results['tensor_cache']
-            root_cache_ids = []
-            for t in tables:
-                root_cache_ids.append(t.root.best_node.cache_id)
-            e_ij = tensor_cache.gather(root_cache_ids, [CacheSlots.E_IJ])[0]
-            logits = self.classifier(e_ij)
-            loss = F.cross_entropy(logits, labels)
-            bilm_loss = results['loss']
-            if not self.disable_parser:
-                sampled_trees = results['sampled_trees']
-                kl_loss = self.parser(input_ids, attention_mask,
-                                    split_masks=sampled_trees['split_masks'],
-                                    split_points=sampled_trees['split_points'])
-            else:
-                kl_loss = 0
-            
-            # force encoding
-            e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans)
-            logits = self.classifier(e_ij)
-            force_encoding_loss = F.cross_entropy(logits, labels)
-            return force_encoding_loss + loss + kl_loss + bilm_loss
-        else:
-            # Implement two mode for inference
-            if not force_encoding:
-                if not self.disable_parser:
-                    s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
-                else:
-                    s_indices = None
+                forced_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
+            zero_loss = torch.zeros((), device=input_ids.device)
+            encodings = []
+            bilm_loss = kl_loss = zero_loss
+            if sampled:
                 results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
-                                    recover_tree=True, keep_tensor_cache=True, lm_loss=False)
+                                    sample_trees=num_samples, recover_tree=True, keep_tensor_cache=True)
                 tables = results['tables']
                 tensor_cache = results['tensor_cache']
-                root_cache_ids = []
-                for t in tables:
-                    root_cache_ids.append(t.root.best_node.cache_id)
-                e_ij = tensor_cache.gather(root_cache_ids, [CacheSlots.E_IJ])[0]
-            else:
-                if self.disable_parser:
-                    raise Exception('Force encoding is not supported when disable_parser == True')
-                e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans)
-            logits = self.classifier(e_ij)
-            return F.softmax(logits, dim=-1)
+                encodings.append(self.gather_root_e_ij(tables, tensor_cache))
+                bilm_loss = results['loss']
+                if not self.disable_parser:
+                    sampled_trees = results['sampled_trees']
+                    kl_loss = self.parser(input_ids, attention_mask,
+                                          split_masks=sampled_trees['split_masks'],
+                                          split_points=sampled_trees['split_points'],
+                                          cached_encoding=parser_encoding)
+
+            with self.autocast():
+                # force encoding
+                encodings.append(force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans,
+                                              s_indices=forced_indices))
+                # classify sampled and forced encodings in one pass
+                logits_all = self.classifier_forward(torch.cat(encodings, dim=0))
+            # cross entropy in fp32
+            logits_all = logits_all.float().split(labels.shape[0])
+            loss = F.cross_entropy(logits_all[0], labels) if sampled else zero_loss
+            force_encoding_loss = F.cross_entropy(logits_all[-1], labels)
+            return torch.stack([self.force_loss_weight * force_encoding_loss, self.sampled_loss_weight * loss,
+                                kl_loss, bilm_loss]).sum()
+        else:
+            with torch.no_grad():
+                # Implement two mode for inference
+                if not force_encoding:
+                    if not self.disable_parser:
+                        s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
+                    else:
+                        s_indices = None
+                    results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
+                                        recover_tree=True, keep_tensor_cache=True, lm_loss=False)
+                    tables = results['tables']
+                    tensor_cache = results['tensor_cache']
+                    e_ij = self.gather_root_e_ij(tables, tensor_cache)
+                else:
+                    if self.disable_parser:
+                        raise Exception('Force encoding is not supported when disable_parser == True')
+                    # the parser stays in fp32, only the composition runs under autocast
+                    forced_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
+                    with self.autocast():
+                        e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans,
+                                            s_indices=forced_indices)
+                with self.autocast():
+                    logits = self.classifier_forward(e_ij)
+                return logits.float()
 
 
-class FastR2D2CrossSentence(nn.Module):
+class FastR2D2CrossSentence(FastR2D2DownstreamBase):
     def __init__(self, config, label_num, disable_parser=False):
-        super().__init__()
-        self.r2d2 = R2D2Cuda(config)
-        self.parser = TopdownParser(config)
-        self.classifier = nn.Sequential(nn.Linear(config.hidden_size, config.intermediate_size),
-                                        nn.GELU(),
-                                        nn.Dropout(config.hidden_dropout_prob),
-                                        nn.Linear(config.intermediate_size, label_num))
+        super().__init__(config, label_num, disable_parser=disable_parser)
         self.task_id = config.pairwise_task_id
-        self.disable_parser = disable_parser
-    
-    def from_pretrain(self, model_path, parser_path):
-        self.r2d2.from_pretrain(model_path)
-        load_model(self.parser, parser_path)
+        self.register_buffer('_mask_id', torch.tensor([self.task_id], dtype=torch.long), persistent=False)
 
-    def load_model(self, model_path):
-        load_model(self, model_path)
-        self.r2d2._tie_weights()
-
-    def pairwise_encoding(self, e_ij):
+    def _prep_input(self, e_ij_flat):
         '''
-        e_ij.shape: [batch_size, 2, dim]
+        e_ij_flat.shape: [batch_size * 2, dim], root encodings of sentence pairs
         '''
+        e_ij = e_ij_flat.view(-1, 2, e_ij_flat.size(-1))  # (batch_size, 2, dim)
         sz = e_ij.shape[0]
-        mask_ids = torch.zeros([
-            sz,
-        ], dtype=torch.long, device=self.r2d2.device).fill_(self.task_id)
-        mask_embedding = self.r2d2.embedding(mask_ids)  # (sz, hidden_dim)
-        input_embedding = torch.cat(
-            [mask_embedding.unsqueeze(1), e_ij], dim=1)  # (?, 3, dim)
+        # look up the task embedding once and broadcast it, the row is not cached as it is trainable
+        mask_embedding = self.r2d2.embedding(self._mask_id).expand(sz, -1)  # (sz, hidden_dim)
+        return torch.cat([mask_embedding.unsqueeze(1), e_ij], dim=1)  # (?, 3, dim)
+
+    def _decode(self, input_embedding):
+        '''
+        input_embedding.shape: [batch_size, 3, dim]
+        '''
         outputs = self.r2d2.tree_decoder(input_embedding)  # (?, 3, dim)
-        mask_hidden = outputs[:, 0, :]  # (?, dim)
-        return self.classifier(mask_hidden)
+        return outputs[:, 0, :]  # (?, dim)
+
+    def pairwise_hidden(self, e_ij_flat):
+        '''
+        e_ij_flat.shape: [batch_size * 2, dim]
+        '''
+        return self._decode(self._prep_input(e_ij_flat))
+
+    def pairwise_encoding(self, e_ij_flat):
+        '''
+        e_ij_flat.shape: [batch_size * 2, dim]
+        '''
+        return self.classifier_forward(self.pairwise_hidden(e_ij_flat))
 
     def forward(self, input_ids: torch.Tensor,
                 attention_mask: torch.Tensor,
@@ -135,56 +212,76 @@ class FastR2D2CrossSentence(nn.Module):
         """
         input_ids: shape: [batch_size, 2, max_ids_len]
         attention_mask: [batch_size, 2, max_ids_len]
+        return: the training loss if labels are given, otherwise logits of shape [batch_size, label_num]
         """
-        input_ids = input_ids.view(-1, input_ids.shape[-1])
-        attention_mask = attention_mask.view(-1, attention_mask.shape[-1])
+        bs, _, max_len = input_ids.shape
+        input_ids = input_ids.reshape(bs * 2, max_len)
+        attention_mask = attention_mask.reshape(bs * 2, max_len)
+        if atom_spans is not None and not isinstance(atom_spans, PackedAtomSpans):
+            # pack once, shared by all parser calls below
+            atom_spans = pack_atom_spans(atom_spans, device=input_ids.device)
         if labels is not None:
             # training
-            if not self.disable_parser:
-                s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
+            sampled = self.sampled_loss_weight > 0
+            zero_loss = torch.zeros((), device=input_ids.device)
+            encodings = []
+            bilm_loss = kl_loss = zero_loss
+            # sampled and forced merge orders share one parser encoding
+            if sampled and not self.disable_parser:
+                s_indices, forced_indices, parser_encoding = self.parser.parse_with_forced(input_ids, attention_mask,
+                                                                                           atom_spans=atom_spans)
             else:
                 s_indices = None
-            results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
-                                sample_trees=num_samples, recover_tree=True, keep_tensor_cache=True,
-                                lm_loss=True)
-            tables = results['tables']
-            tensor_cache = results['tensor_cache']
-            sampled_trees = results['sampled_trees']
-            root_cache_ids = []
-            for t in tables:
-                root_cache_ids.append(t.root.best_node.cache_id)
-            e_ij = tensor_cache.gather(root_cache_ids, [CacheSlots.E_IJ])[0]
-            logits = self.pairwise_encoding(e_ij.view(e_ij.shape[0] // 2, 2, e_ij.shape[-1]))
-            loss = F.cross_entropy(logits, labels)
-            bilm_loss = results['loss']
-            kl_loss = self.parser(input_ids, attention_mask,
-                                  split_masks=sampled_trees['split_masks'],
-                                  split_points=sampled_trees['split_points'])
-            
-            # force encoding
-            e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans)
-            logits = self.pairwise_encoding(e_ij.view(e_ij.shape[0] // 2, 2, e_ij.shape[-1]))
-            force_encoding_loss = F.cross_entropy(logits, labels)
-            return force_encoding_loss + loss + kl_loss + bilm_loss
-        else:
-            # Implement two mode for inference
-            if not force_encoding:
-                if not self.disable_parser:
-                    s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
-                else:
-                    s_indices = None
+                parser_encoding = None
+                forced_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
+            if sampled:
                 results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
-                                    recover_tree=True, keep_tensor_cache=True,
-                                    lm_loss=False)
+                                    sample_trees=num_samples, recover_tree=True, keep_tensor_cache=True,
+                                    lm_loss=True)
                 tables = results['tables']
                 tensor_cache = results['tensor_cache']
-                root_cache_ids = []
-                for t in tables:
-                    root_cache_ids.append(t.root.best_node.cache_id)
-                e_ij = tensor_cache.gather(root_cache_ids, [CacheSlots.E_IJ])[0]
-            else:
-                if self.disable_parser:
-                    raise Exception('Force encoding is not supported when disable_parser == True')
-                e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans)
-            logits = self.pairwise_encoding(e_ij.view(e_ij.shape[0] // 2, 2, e_ij.shape[-1]))
-            return F.softmax(logits, dim=-1)
\ No newline at end of file
+                sampled_trees = results['sampled_trees']
+                encodings.append(self.gather_root_e_ij(tables, tensor_cache))
+                bilm_loss = results['loss']
+                kl_loss = self.parser(input_ids, attention_mask,
+                                      split_masks=sampled_trees['split_masks'],
+                                      split_points=sampled_trees['split_points'],
+                                      cached_encoding=parser_encoding)
+
+            with self.autocast():
+                # force encoding
+                encodings.append(force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans,
+                                              s_indices=forced_indices))
+                # decode and classify sampled and forced pairs in one pass
+                logits_all = self.pairwise_encoding(torch.cat(encodings, dim=0))
+            # cross entropy in fp32
+            logits_all = logits_all.float().split(bs)
+            loss = F.cross_entropy(logits_all[0], labels) if sampled else zero_loss
+            force_encoding_loss = F.cross_entropy(logits_all[-1], labels)
+            return torch.stack([self.force_loss_weight * force_encoding_loss, self.sampled_loss_weight * loss,
+                                kl_loss, bilm_loss]).sum()
+        else:
+            with torch.no_grad():
+                # Implement two mode for inference
+                if not force_encoding:
+                    if not self.disable_parser:
+                        s_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans)
+                    else:
+                        s_indices = None
+                    results = self.r2d2(input_ids, attention_mask, merge_trajectories=s_indices,
+                                        recover_tree=True, keep_tensor_cache=True,
+                                        lm_loss=False)
+                    tables = results['tables']
+                    tensor_cache = results['tensor_cache']
+                    e_ij = self.gather_root_e_ij(tables, tensor_cache)
+                else:
+                    if self.disable_parser:
+                        raise Exception('Force encoding is not supported when disable_parser == True')
+                    # the parser stays in fp32, only the composition runs under autocast
+                    forced_indices = self.parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
+                    with self.autocast():
+                        e_ij = force_encode(self.parser, self.r2d2, input_ids, attention_mask, atom_spans,
+                                            s_indices=forced_indices)
+                with self.autocast():
+                    logits = self.pairwise_encoding(e_ij)
+                return logits.float()
\ No newline at end of file
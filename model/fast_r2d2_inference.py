@@ -68,9 +68,14 @@ def build_batch(s_indices, seq_lens):
     return encoding_batchs, root_ids
 
 
-def force_encode(parser, r2d2, input_ids, attention_mask, atom_spans: List[List[Tuple[int]]]):
+def force_encode(parser, r2d2, input_ids, attention_mask, atom_spans: List[List[Tuple[int]]],
+                 s_indices: torch.Tensor = None):
+    """
+    s_indices: merge order given by the parser, computed here if not provided
+    """
+    if s_indices is None:
+        s_indices = parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
     # initialize tensor cache
-    s_indices = parser(input_ids, attention_mask, atom_spans=atom_spans, add_noise=False)
     seq_lens = torch.sum(attention_mask, dim=1, dtype=torch.int)  # (batch_size, 1)
     seq_lens_np = seq_lens.to('cpu').data.numpy()
     e_ij_cache = torch.full([sum(seq_lens) * 2, r2d2.input_dim], 0.0, device=r2d2.device)
@@ -34,7 +34,7 @@ class R2D2(R2D2Base):
         assert left.shape[0] == right.shape[0], "infer(): batch size of left and right doesn't match!"
         bigrams = torch.cat([left.unsqueeze(1), right.unsqueeze(1)], dim=1)
         sz = bigrams.shape[0]
-        mask_ids = torch.zeros([sz, ], dtype=torch.long).fill_(self.mask_token_id).to(self.device)
+        mask_ids = torch.full((sz,), self.mask_token_id, dtype=torch.long, device=self.device)
         mask_embedding = self.embedding(mask_ids)  # (sz, hidden_dim)
         input_embedding = torch.cat([mask_embedding.unsqueeze(1), bigrams], dim=1)  # (?, 3, dim)
         outputs = self.tree_encoder(input_embedding.transpose(0, 1)).transpose(0, 1)  # (?, 3, dim)
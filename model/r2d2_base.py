@@ -24,19 +24,29 @@ class R2D2Base(nn.Module):
         self.eos_token_id = config.eos_token_id
         self.nsp_token_id = config.nsp_token_id
         self.sum_token_id = config.sum_token_id
+        self._device = None
 
         self._initialize_weights()
         self._tie_weights()
 
     def _tie_weights(self):
-        self.classifier.weight = self.embedding.weight
+        if self.classifier.weight is not self.embedding.weight:
+            self.classifier.weight = self.embedding.weight
 
     def _initialize_weights(self):
         self.embedding.weight.data.normal_(mean=0, std=0.02)
 
     @property
     def device(self):
-        return next(self.parameters()).device
+        # resolved lazily and memoized, looked up many times per step while encoding
+        if self._device is None:
+            self._device = next(self.parameters()).device
+        return self._device
+
+    def _apply(self, fn, *args, **kwargs):
+        # parameters may be moved by to()/cuda()/cpu(), resolve the device again on next access
+        self._device = None
+        return super()._apply(fn, *args, **kwargs)
 
     @property
     def eos_vec(self):
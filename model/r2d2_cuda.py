@@ -85,9 +85,7 @@ class R2D2Cuda(R2D2Base):
         :return: Logits on vocabulary: (batch_size, vocab_size)
         """
         sz = tensor_batch.shape[0]
-        mask_ids = torch.zeros([
-            sz,
-        ], dtype=torch.long, device=self.device).fill_(self.mask_token_id)
+        mask_ids = torch.full((sz,), self.mask_token_id, dtype=torch.long, device=self.device)
         mask_embedding = self.embedding(mask_ids)  # (sz, hidden_dim)
         input_embedding = torch.cat(
             [mask_embedding.unsqueeze(1), tensor_batch], dim=1)  # (?, 3, dim)
@@ -195,10 +193,8 @@ class R2D2Cuda(R2D2Base):
         return flatten_input_ids, embeddings
 
     def _topk(self, group_ids, log_p_ids, tensor_cache, combination_size):
-        e_ij = tensor_cache.gather(group_ids.flatten(),
-                                   [CacheSlots.E_IJ])[0]
-        log_p_ij = tensor_cache.gather(log_p_ids.flatten(),
-                                       [CacheSlots.LOG_P_IJ_SUM])[0]
+        e_ij = tensor_cache.index_select(group_ids.flatten(), CacheSlots.E_IJ)
+        log_p_ij = tensor_cache.index_select(log_p_ids.flatten(), CacheSlots.LOG_P_IJ_SUM)
         e_ij = e_ij.view(*group_ids.shape, self.input_dim)
         log_p_ij = log_p_ij.view(*group_ids.shape)
 
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from typing import List, Tuple
 import torch.nn.functional as F
 import torch.nn as nn
@@ -6,6 +7,51 @@ import numpy as np
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
+PackedAtomSpans = namedtuple(
+    'PackedAtomSpans',
+    [
+        'spans',  # (batch_size, max_span_num, 2), each span contains start and end position
+        'span_nums'  # (batch_size), number of valid spans of each sentence
+    ]
+)
+
+
+def pack_atom_spans(atom_spans: List[List[Tuple[int]]], device=None):
+    """
+    Pack atom spans into a padded tensor once so that callees don't iterate the nested lists again.
+    """
+    span_nums = [len(spans) if spans is not None else 0 for spans in atom_spans]
+    max_span_num = max(span_nums + [1])
+    padded_spans = [list(spans or []) + [(0, 0)] * (max_span_num - span_num)
+                    for spans, span_num in zip(atom_spans, span_nums)]
+    spans = torch.tensor(padded_spans, dtype=torch.long, device=device).view(len(atom_spans), max_span_num, 2)
+    return PackedAtomSpans(spans, torch.tensor(span_nums, dtype=torch.long, device=device))
+
+
+def atom_spans_points_mask(atom_spans, scores):
+    """
+    Mark split points inside atom spans with 1.
+    params:
+        atom_spans: List[List[Tuple[int]]] or PackedAtomSpans
+        scores: (batch_size, L - 1), split point scores
+    return: (batch_size, L - 1) long tensor on the device of scores
+    """
+    if isinstance(atom_spans, PackedAtomSpans):
+        # same as points_mask[batch_i][i: j] = 1 for each span (i, j) below, without iterating the spans
+        spans = atom_spans.spans.to(scores.device)
+        span_nums = atom_spans.span_nums.to(scores.device)
+        positions = torch.arange(scores.shape[1], device=scores.device)  # (L - 1)
+        valid = torch.arange(spans.shape[1], device=scores.device).unsqueeze(0) < span_nums.unsqueeze(1)
+        in_span = (positions >= spans[:, :, 0:1]) & (positions < spans[:, :, 1:2]) & valid.unsqueeze(2)
+        return in_span.any(dim=1).long()
+    points_mask = np.full(scores.shape, fill_value=0)
+    for batch_i, spans in enumerate(atom_spans):
+        if spans is not None:
+            for (i, j) in spans:
+                points_mask[batch_i][i: j] = 1
+    return torch.tensor(points_mask, device=scores.device)
+
+
 class TopdownParser(nn.Module):
     def __init__(self, config) -> None:
         super().__init__()
@@ -35,6 +81,33 @@ class TopdownParser(nn.Module):
         scores = self.score_mlp(output)  # meaningful split points: seq_lens - 1
         return scores.squeeze(-1)
 
+    def _merge_order(self, scores, attention_mask, atom_spans: List[List[Tuple[int]]] = None,
+                     add_noise: bool = True):
+        # meaningful split points: seq_lens - 1
+        if atom_spans is not None:
+            # scores.masked_fill_(attention_mask[:, 1:scores.shape[1] + 1] == 0, float('-inf'))
+            points_mask = atom_spans_points_mask(atom_spans, scores)
+            mask_scores = points_mask * (scores.max() - scores.min() + 1)
+            scores = scores - mask_scores
+
+        # not in-place, scores may be shared by several merge orders
+        scores = scores.masked_fill(attention_mask[:, 1:scores.shape[1] + 1] == 0, float('inf'))
+
+        if self.training and add_noise:
+            noise = -torch.empty_like(
+                scores,
+                memory_format=torch.legacy_contiguous_format,
+                requires_grad=False).exponential_().log()
+        else:
+            noise = torch.zeros_like(scores, requires_grad=False)
+        scores = scores + noise
+
+        # split according to scores
+        # for torch >= 1.9
+        # _, s_indices = scores.sort(dim=-1, descending=False, stable=True)
+        _, s_indices = scores.sort(dim=-1, descending=False)
+        return s_indices  # merge order
+
     def parse(self, input_ids: torch.Tensor = None, attention_mask: torch.Tensor = None,
               atom_spans: List[List[Tuple[int]]] = None, splits: List[List[int]] = None,
               add_noise: bool = True):
@@ -42,57 +115,51 @@ class TopdownParser(nn.Module):
         params:
             input_ids: torch.Tensor, 
             attention_mask:
-            atom_spans: List[List[Tuple[int]]], batch_size * span_lens * 2, each span contains start and end position
+            atom_spans: List[List[Tuple[int]]], batch_size * span_lens * 2, each span contains start and end position,
+                        or the packed form returned by pack_atom_spans
             splits: List[List[int]], batch_size * split_num, list of split positions
         """
         with torch.no_grad():
             scores = self._split_point_scores(input_ids, attention_mask.sum(dim=-1))
-            # meaningful split points: seq_lens - 1
-
-            if atom_spans is not None:
-                # scores.masked_fill_(attention_mask[:, 1:scores.shape[1] + 1] == 0, float('-inf'))
-                points_mask = np.full(scores.shape, fill_value=0)
-                for batch_i, spans in enumerate(atom_spans):
-                    if spans is not None:
-                        for (i, j) in spans:
-                            points_mask[batch_i][i: j] = 1
-                points_mask = torch.tensor(points_mask, device=scores.device)
-                mask_scores = points_mask * (scores.max() - scores.min() + 1)
-                scores = scores - mask_scores
-
-            scores.masked_fill_(attention_mask[:, 1:scores.shape[1] + 1] == 0, float('inf'))
-
-            if self.training and add_noise:
-                noise = -torch.empty_like(
-                    scores,
-                    memory_format=torch.legacy_contiguous_format,
-                    requires_grad=False).exponential_().log()
-            else:
-                noise = torch.zeros_like(scores, requires_grad=False)
-            scores = scores + noise
+            return self._merge_order(scores, attention_mask, atom_spans, add_noise=add_noise)
 
-            # split according to scores
-            # for torch >= 1.9
-            # _, s_indices = scores.sort(dim=-1, descending=False, stable=True)
-            _, s_indices = scores.sort(dim=-1, descending=False)
-            return s_indices  # merge order
+    def parse_with_forced(self, input_ids: torch.Tensor = None, attention_mask: torch.Tensor = None,
+                          atom_spans: List[List[Tuple[int]]] = None):
+        """
+        Run the encoder once and return the noised merge order used for sampling trees,
+        the noise-free merge order used by force encoding and the split point scores,
+        which could be passed back as cached_encoding to compute the kl loss.
+        """
+        scores = self._split_point_scores(input_ids, attention_mask.sum(dim=-1))
+        with torch.no_grad():
+            detached_scores = scores.detach()
+            s_indices = self._merge_order(detached_scores, attention_mask, atom_spans, add_noise=True)
+            forced_indices = self._merge_order(detached_scores, attention_mask, atom_spans, add_noise=False)
+        return s_indices, forced_indices, scores
 
     def forward(self, input_ids: torch.Tensor = None, attention_mask: torch.Tensor = None,
                 split_masks: torch.Tensor = None, split_points: torch.Tensor = None,
-                atom_spans: List[List[Tuple[int]]] = None, add_noise: bool = True):
+                atom_spans: List[List[Tuple[int]]] = None, add_noise: bool = True,
+                cached_encoding: torch.Tensor = None):
+        """
+        cached_encoding: split point scores returned by parse_with_forced, skips the encoder when computing the kl loss
+        """
         if split_masks is None:
             return self.parse(input_ids, attention_mask=attention_mask, atom_spans=atom_spans, add_noise=add_noise)
         else:
             assert split_masks is not None and split_points is not None
             # split_masks: (batch_size, sample_size, L - 1, L - 1)
             # split points: (batch_size, sample_size, L - 1)
-            scores = self._split_point_scores(input_ids, attention_mask.sum(dim=-1))
+            if cached_encoding is not None:
+                scores = cached_encoding
+            else:
+                scores = self._split_point_scores(input_ids, attention_mask.sum(dim=-1))
             # (batch_size, L - 1)
-            scores.masked_fill_(attention_mask[:, 1:] == 0, float('-inf'))
+            scores = scores.masked_fill(attention_mask[:, 1:] == 0, float('-inf'))
             scores = scores.unsqueeze(1).unsqueeze(2).repeat(1, split_masks.shape[1], split_masks.shape[-1], 1)
             scores.masked_fill_(split_masks == 0, float('-inf'))
             # test only feedback on root split
             log_p = F.log_softmax(scores, dim=-1)  # (batch_size, K, L - 1, L - 1)
             loss = F.nll_loss(log_p.permute(0, 3, 1, 2), split_points, ignore_index=-1, reduction='none')
             loss = loss.sum(dim=-1) / attention_mask.sum(dim=-1).unsqueeze(1).repeat(1, split_points.shape[1])
-            return loss.mean()
\ No newline at end of file
+            return loss.mean()
@@ -1,8 +1,11 @@
 from model.fast_r2d2_downstream import FastR2D2Classification
+from model.r2d2_base import R2D2Base
 from unittest import TestCase
 import tqdm
 import numpy as np
 import json
+import os
+import tempfile
 import torch
 
 class dotdict(dict):
@@ -71,4 +74,62 @@ class TestFastR2D2(TestCase):
             model(
                 input_ids=ids,
                 attention_mask=masks
-            )
\ No newline at end of file
+            )
+
+    def test_skip_sampled_pass(self):
+        config = dotdict(json.loads(mini_r2d2_config))
+        model = FastR2D2Classification(config, 2)
+        self.assertEqual(model.sampled_loss_weight, 1.0)
+        self.assertEqual(model.force_loss_weight, 1.0)
+
+        config.sampled_loss_weight = 0
+        model = FastR2D2Classification(config, 2)
+        self.assertEqual(model.sampled_loss_weight, 0.0)
+
+        def sampled_pass(*args, **kwargs):
+            raise AssertionError('the sampled R2D2 pass should be skipped')
+        model.r2d2.forward = sampled_pass
+
+        seq_lens = [5, 3, 1]
+        max_len = max(seq_lens)
+        masks = torch.tensor([[1] * seq_len + [0] * (max_len - seq_len) for seq_len in seq_lens])
+        ids = torch.randint(0, config.vocab_size, [len(seq_lens), max_len])
+        labels = torch.tensor([0, 1, 1])
+        loss = model(input_ids=ids, attention_mask=masks, labels=labels)
+        self.assertTrue(torch.isfinite(loss))
+        loss.backward()
+
+    def test_from_pretrain_merged(self):
+        torch.manual_seed(0)
+        config = dotdict(json.loads(mini_r2d2_config))
+        model = FastR2D2Classification(config, 2)
+        with tempfile.TemporaryDirectory() as output_dir:
+            merged_path = os.path.join(output_dir, 'merged.bin')
+            state_dict = {k: v for k, v in model.state_dict().items() if not k.startswith('classifier.')}
+            torch.save(state_dict, merged_path)
+            r2d2_path = os.path.join(output_dir, 'model.bin')
+            torch.save(model.r2d2.state_dict(), r2d2_path)
+
+            loaded = FastR2D2Classification(config, 2)
+            loaded.from_pretrain(merged_path)
+            loaded_state_dict = loaded.state_dict()
+            for k, v in state_dict.items():
+                self.assertTrue(torch.equal(v, loaded_state_dict[k]), k)
+            self.assertIs(loaded.r2d2.classifier.weight, loaded.r2d2.embedding.weight)
+
+            with self.assertRaises(Exception):
+                FastR2D2Classification(config, 2).from_pretrain(r2d2_path)
+
+    def test_device_memo(self):
+        config = dotdict(json.loads(mini_r2d2_config))
+        r2d2 = R2D2Base(config)
+        self.assertEqual(r2d2.device, torch.device('cpu'))
+        self.assertIsNotNone(r2d2._device)
+
+        r2d2.to(torch.float64)
+        self.assertIsNone(r2d2._device)
+        self.assertEqual(r2d2.device, torch.device('cpu'))
+
+        r2d2.to('meta')
+        self.assertIsNone(r2d2._device)
+        self.assertEqual(r2d2.device.type, 'meta')
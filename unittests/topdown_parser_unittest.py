@@ -0,0 +1,113 @@
+from model.topdown_parser import TopdownParser, pack_atom_spans, atom_spans_points_mask, PackedAtomSpans
+from unittest import TestCase
+import numpy as np
+import torch
+
+
+class dotdict(dict):
+    """dot.notation access to dictionary attributes"""
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+
+mini_parser_config = dotdict({
+    "vocab_size": 100,
+    "hidden_dropout_prob": 0.1,
+    "parser_hidden_dim": 16,
+    "parser_input_dim": 8,
+    "parser_num_layers": 2
+})
+
+
+class TestTopdownParser(TestCase):
+    def _random_inputs(self, batch_size, max_len):
+        input_ids = torch.randint(0, mini_parser_config.vocab_size, [batch_size, max_len])
+        seq_lens = [max_len] + [np.random.randint(2, max_len + 1) for _ in range(batch_size - 1)]
+        attention_mask = torch.tensor([[1] * seq_len + [0] * (max_len - seq_len) for seq_len in seq_lens])
+        return input_ids, attention_mask
+
+    def test_parse_with_forced(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        parser = TopdownParser(mini_parser_config)
+        parser.eval()
+        input_ids, attention_mask = self._random_inputs(4, 10)
+        atom_spans = [[(1, 3)], None, [], [(0, 2), (5, 20)]]
+        for spans in [None, atom_spans, pack_atom_spans(atom_spans)]:
+            s_indices, forced_indices, scores = parser.parse_with_forced(input_ids, attention_mask,
+                                                                         atom_spans=spans)
+            self.assertTrue(scores.requires_grad)
+            self.assertTrue(torch.equal(s_indices, parser.parse(input_ids, attention_mask, atom_spans=spans,
+                                                                add_noise=True)))
+            self.assertTrue(torch.equal(forced_indices, parser.parse(input_ids, attention_mask, atom_spans=spans,
+                                                                     add_noise=False)))
+
+    def test_cached_encoding(self):
+        torch.manual_seed(0)
+        np.random.seed(0)
+        parser = TopdownParser(mini_parser_config)
+        parser.eval()
+        batch_size, sample_size, max_len = 3, 2, 8
+        input_ids = torch.randint(0, mini_parser_config.vocab_size, [batch_size, max_len])
+        # full length sentences and masks keep every row of the kl loss finite
+        attention_mask = torch.ones(batch_size, max_len, dtype=torch.long)
+        split_masks = torch.ones(batch_size, sample_size, max_len - 1, max_len - 1, dtype=torch.long)
+        split_points = torch.randint(-1, max_len - 1, [batch_size, sample_size, max_len - 1])
+
+        parser.zero_grad()
+        loss = parser(input_ids, attention_mask, split_masks=split_masks, split_points=split_points)
+        loss.backward()
+        grads = [p.grad.clone() for p in parser.parameters()]
+
+        parser.zero_grad()
+        _, _, scores = parser.parse_with_forced(input_ids, attention_mask)
+        cached_loss = parser(input_ids, attention_mask, split_masks=split_masks, split_points=split_points,
+                             cached_encoding=scores)
+        cached_loss.backward()
+
+        self.assertTrue(torch.allclose(loss, cached_loss))
+        for grad, p in zip(grads, parser.parameters()):
+            self.assertTrue(torch.allclose(grad, p.grad, atol=1e-6))
+
+    def test_packed_points_mask(self):
+        max_len = 8
+        # None entries, empty span lists and spans running past L - 1
+        atom_spans = [
+            [(0, 2), (4, 6)],
+            None,
+            [],
+            [(5, 12)],
+            [(1, 3), (2, 4), (7, 7)]
+        ]
+        scores = torch.zeros(len(atom_spans), max_len - 1)
+        packed = pack_atom_spans(atom_spans)
+        self.assertIsInstance(packed, PackedAtomSpans)
+        self.assertEqual(packed.spans.shape, (len(atom_spans), 3, 2))
+        self.assertEqual(packed.span_nums.tolist(), [2, 0, 0, 1, 3])
+
+        expected = atom_spans_points_mask(atom_spans, scores)
+        actual = atom_spans_points_mask(packed, scores)
+        self.assertEqual(actual.dtype, expected.dtype)
+        self.assertTrue(torch.equal(actual, expected))
+
+        # a tuple of per sentence span lists is not the packed form
+        actual = atom_spans_points_mask(pack_atom_spans(tuple(atom_spans)), scores)
+        self.assertTrue(torch.equal(actual, expected))
+
+    def test_packed_points_mask_random(self):
+        np.random.seed(0)
+        for _ in range(20):
+            batch_size, max_len = np.random.randint(1, 6), np.random.randint(2, 20)
+            atom_spans = []
+            for _ in range(batch_size):
+                span_num = np.random.randint(0, 4)
+                spans = []
+                for _ in range(span_num):
+                    st = np.random.randint(0, max_len)
+                    spans.append((st, st + np.random.randint(1, max_len)))
+                atom_spans.append(spans if span_num > 0 or np.random.rand() < 0.5 else None)
+            scores = torch.zeros(batch_size, max_len - 1)
+            expected = atom_spans_points_mask(atom_spans, scores)
+            actual = atom_spans_points_mask(pack_atom_spans(atom_spans), scores)
+            self.assertTrue(torch.equal(actual, expected))
@@ -1,15 +1,23 @@
 import glob
 import torch
 import os
+from packaging import version
 
 
-def load_model(model, model_path, strict=True):
-    state_dict = torch.load(model_path, map_location=lambda a, b: a)
+def load_state_dict(model_path, mmap=False):
+    if mmap and version.parse(torch.__version__) >= version.parse('2.1'):
+        # map the file instead of reading it into a second buffer before the copy into parameters
+        return torch.load(model_path, map_location=lambda a, b: a, mmap=True)
+    return torch.load(model_path, map_location=lambda a, b: a)
+
+
+def load_model(model, model_path, strict=True, mmap=False):
+    state_dict = load_state_dict(model_path, mmap=mmap)
     transfered_state_dict = {}
     for k, v in state_dict.items():
         new_k = k.replace('module.', '')
         transfered_state_dict[new_k] = v
-    model.load_state_dict(transfered_state_dict, strict=strict)
+    return model.load_state_dict(transfered_state_dict, strict=strict)
 
 
 def load_checkpoint(modules, files, output_dir):
@@ -100,6 +100,10 @@ class PyTable:
     def root(self):
         return self._root
 
+    @property
+    def root_cache_id(self):
+        return self._root.best_node.cache_id
+
     @property
     def seq_len(self):
         return self._seq_len